@@ -1,3 +1,9 @@
+import os
+
+if __name__ == "__main__":
+    # Read once when OpenMP starts, i.e. on the torch import below
+    os.environ.setdefault("OMP_WAIT_POLICY", "PASSIVE")
+
 import json
 import torch
 import torch.nn as nn
@@ -8,51 +14,312 @@ import torchvision
 from torchvision import datasets, models, transforms
 from matplotlib import pyplot as plt
 import time
-import os
 import copy
-from torch.utils.data import Dataset, DataLoader
+import argparse
+import hashlib
+import shutil
+import functools
+import collections
+from typing import Dict, List
+import pathlib
+from torch.utils.data import Dataset, DataLoader, get_worker_info
 from torchvision import transforms, utils
 from helper_functions import *
 from transformers import AutoTokenizer
 import faiss
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@njit(cache=True)
+def build_ids(token_ids, cls_id, sep_id, pad_id, max_len):
+    '''
+    Add CLS/SEP ids to token ids and pad them to max_len
+
+    Arguments:
+        token_ids - int32 numpy array of token ids
+        cls_id, sep_id, pad_id - special token ids
+        max_len - length of the output arrays
+
+    Returns:
+        input_ids - int32 numpy array of length max_len
+        attention_mask - int8 numpy array of length max_len
+    '''
+
+    input_ids = np.empty(max_len, dtype=np.int32)
+    attention_mask = np.zeros(max_len, dtype=np.int8)
+    n = min(len(token_ids), max_len - 2)
+
+    input_ids[0] = cls_id
+    for i in range(n):
+        input_ids[i + 1] = token_ids[i]
+    input_ids[n + 1] = sep_id
+    for i in range(n + 2, max_len):
+        input_ids[i] = pad_id
+    for i in range(n + 2):
+        attention_mask[i] = 1
+
+    return input_ids, attention_mask
+
+
+# Compile at import so the first batch does not pay for it
+build_ids(np.zeros(1, dtype=np.int32), 0, 0, 0, 4)
+
+def reconstruct_batch(index, ids):
+    '''
+    Reconstruct several vectors from a faiss index in a single call
+
+    Arguments:
+        index - faiss index
+        ids - int64 numpy array of vector ids
+
+    Returns:
+        float32 numpy array of shape (len(ids), index.d)
+    '''
+
+    if len(ids) == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+
+    if hasattr(index, "reconstruct_batch"):
+        return index.reconstruct_batch(ids)
+
+    # Older faiss versions only reconstruct contiguous ranges, use one when it
+    # is not much larger than the requested ids
+    start = int(ids.min())
+    span = int(ids.max()) - start + 1
+    if span <= 2 * len(ids):
+        vectors = index.reconstruct_n(start, span)
+        return vectors[ids - start]
+
+    vectors = np.empty((len(ids), index.d), dtype=np.float32)
+    for i, vector_id in enumerate(ids):
+        vectors[i] = index.reconstruct(int(vector_id))
+    return vectors
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    '''
+    IndicBERT fast tokenizer shared by all datasets in the process
+    '''
+
+    return AutoTokenizer.from_pretrained("ai4bharat/indic-bert", use_fast=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_lang(index_path, lang):
+    '''
+    Load the vocabulary and faiss index of a language once per process
+
+    Arguments:
+        index_path - directory with the faiss indices and vocabularies
+        lang - language code
+
+    Returns:
+        word2idx - dictionary mapping utf-8 encoded words to vector ids
+        index - faiss index, only used for read-only reconstruction
+    '''
+
+    lines = pathlib.Path(os.path.join(index_path, lang + ".vocab")).read_bytes().splitlines()
+    word2idx = dict(zip(lines, range(len(lines))))
+
+    index = faiss.read_index(os.path.join(index_path, lang + ".index"))
+
+    return word2idx, index
+
+
+# Bump when the layout or dtypes of the cached features change
+FEATURES_VERSION = "4"
+
+
+def save_features(cache_path, features):
+    '''
+    Save feature arrays as one .npy file each so they can be memory-mapped,
+    and remove older caches of the same dataset. The cache is only an
+    optimization, so failing to write it is reported and ignored
+
+    Arguments:
+        cache_path - directory to write the arrays to, named <dataset>.<key>
+        features - dictionary of numpy arrays
+    '''
+
+    tmp_path = cache_path + ".tmp{}".format(os.getpid())
+    try:
+        os.makedirs(tmp_path)
+        for name, array in features.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+    except OSError as e:
+        print("Not caching features: {}".format(e))
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process wrote the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # Caches keyed by an older dataset, index or feature version are stale
+    cache_dir, name = os.path.split(cache_path)
+    prefix = name.rsplit(".", 1)[0] + "."
+    for other in os.listdir(cache_dir):
+        other_path = os.path.join(cache_dir, other)
+        key = other[len(prefix):]
+        if other.startswith(prefix) and other_path != cache_path and len(key) == len(name) - len(prefix) and "." not in key:
+            shutil.rmtree(other_path, ignore_errors=True)
+
+
+def load_features(cache_path):
+    '''
+    Memory-map feature arrays saved with save_features
+
+    Arguments:
+        cache_path - directory with the saved arrays
+
+    Returns:
+        features - dictionary of memory-mapped numpy arrays
+    '''
+
+    features = {}
+    for name in os.listdir(cache_path):
+        # Copy-on-write maps stay lazy but are writeable, which torch.from_numpy expects
+        features[os.path.splitext(name)[0]] = np.load(os.path.join(cache_path, name), mmap_mode="c")
+
+    return features
+
+
 class XLingualTrainDataset(Dataset):
     '''
     Reverse dictionary data loader for training
     '''
 
-    def __init__(self, dataset_path, index_path):
+    def __init__(self, dataset_path, index_path, cache_dir=None):
         '''
         Init class method
 
         Arguments:
             dataset_path - path to json data
             index_paths - dict that maps language tag to faiss index path
+            cache_dir - directory for cached features, defaults to .feature_cache in the dataset directory
         '''
 
-        lang_map = {'HI': 'hi', 'BE': 'bn', 'GU': 'gu', 'OD': 'or', 'PU': 'pa', 'EN': 'en', 'MA': 'mr'}
-        dataset = read_json_file(dataset_path)
-        self.phrases = list()
-        self.targets = list()
-        self.tokenizer = AutoTokenizer.from_pretrained("ai4bharat/indic-bert")
+        self.language_ids = {'HI': 0, 'BE': 1, 'GU': 2, 'OD': 3, 'PU': 4, 'EN': 5, 'MA': 6}
+        self.id_to_lang = sorted(self.language_ids, key=self.language_ids.get)
         self.max_seq_length = 128
+        #self.langs = ['en', 'hi', 'gu', 'pa', 'or', 'mr', 'bn']
+        self.langs = ['en']
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(dataset_path)), ".feature_cache")
+        with open(dataset_path, 'rb') as f:
+            json_bytes = f.read()
+        cache_path = os.path.join(cache_dir, os.path.basename(dataset_path) + "." + self.cache_key(json_bytes, index_path))
+
+        if os.path.isdir(cache_path):
+            features = load_features(cache_path)
+        else:
+            features = self.build_features(parse_json_bytes(json_bytes), index_path)
+            save_features(cache_path, features)
+
+        # One tensor per field wrapped once, __getitem__ returns views into them.
+        # Phrase features are (U, 128) over distinct phrases, indexed through text_idx
+        self.text_idx = features["text_idx"]
+        self.input_ids_u = torch.from_numpy(features["input_ids"])
+        self.attention_u = torch.from_numpy(features["attention_mask"])
+        self.token_types_u = torch.from_numpy(features["token_type_ids"])
+        self.target_t = torch.from_numpy(features["targets"])
+        self.src_lang_t = torch.from_numpy(features["src_lang_ids"])
+        self.tgt_lang_t = torch.from_numpy(features["tgt_lang_ids"])
+
+
+    def cache_key(self, json_bytes, index_path):
+        '''
+        Hash of everything the cached features depend on
 
-        #for lang in ['en', 'hi', 'gu', 'pa', 'or', 'mr', 'bn']:
-        for lang in ['en']:
-            with open(os.path.join(index_path, lang + ".vocab"), 'r') as f:
-                word2idx = {line.strip(): i for i, line in enumerate(f)}
+        Arguments:
+            json_bytes - raw contents of the dataset json
+            index_path - directory with the faiss indices and vocabularies
+        '''
 
-            index = faiss.read_index(os.path.join(index_path, lang + ".index"))
+        key = hashlib.blake2b(digest_size=16)
+        key.update(json_bytes)
+        key.update(FEATURES_VERSION.encode())
+        key.update("ai4bharat/indic-bert".encode())
+        key.update(str(self.max_seq_length).encode())
+        for lang in self.langs:
+            for ext in [".vocab", ".index"]:
+                path = os.path.abspath(os.path.join(index_path, lang + ext))
+                key.update("{}:{}".format(path, os.path.getmtime(path)).encode())
 
-            for d in dataset:
-                if lang_map[d["Target_ID"]] == lang:
-                    try:
-                        self.targets.append(index.reconstruct(word2idx[d["Target_keyword"]]))
-                        self.phrases.append(d["Source_text"])
-                    except KeyError:
-                        print(d["Target_keyword"] + " not found")
+        return key.hexdigest()
 
-        self.language_ids = {'HI': 0, 'BE': 1, 'GU': 2, 'OD': 3, 'PU': 4, 'EN': 5, 'MA': 6}
+
+    def build_features(self, dataset, index_path):
+        '''
+        Tokenize phrases and look up target vectors
+
+        Arguments:
+            dataset - list of dictionary entries
+            index_path - directory with the faiss indices and vocabularies
+
+        Returns:
+            features - dictionary of numpy arrays
+        '''
+
+        lang_map = {'HI': 'hi', 'BE': 'bn', 'GU': 'gu', 'OD': 'or', 'PU': 'pa', 'EN': 'en', 'MA': 'mr'}
+        phrases = list()
+        targets = list()
+        src_lang_ids = list()
+        tgt_lang_ids = list()
+        tokenizer = get_tokenizer()
+
+        src_langs = np.fromiter((self.language_ids[d["Source_ID"]] for d in dataset), dtype=np.int8, count=len(dataset))
+        target_langs = np.fromiter((self.language_ids[d["Target_ID"]] for d in dataset), dtype=np.int8, count=len(dataset))
+
+        # Group rows by target language in a single pass over the dataset
+        by_lang = collections.defaultdict(list)
+        for i, d in enumerate(dataset):
+            by_lang[lang_map[d["Target_ID"]]].append(i)
+
+        for lang in self.langs:
+            word2idx, index = _load_lang(index_path, lang)
+
+            lang_rows = np.array(by_lang[lang], dtype=np.int64)
+            vocab_ids = np.fromiter((word2idx.get(dataset[i]["Target_keyword"].encode(), -1) for i in lang_rows), dtype=np.int64, count=len(lang_rows))
+            for i in lang_rows[vocab_ids < 0]:
+                print(dataset[i]["Target_keyword"] + " not found")
+
+            rows = lang_rows[vocab_ids >= 0]
+            ids = vocab_ids[vocab_ids >= 0]
+
+            targets.append(reconstruct_batch(index, ids))
+            phrases.extend(dataset[i]["Source_text"] for i in rows)
+            src_lang_ids.append(src_langs[rows])
+            tgt_lang_ids.append(target_langs[rows])
+
+        # Tokenize every distinct phrase once so that __getitem__ only slices
+        # tensors, rows point to their phrase through text_idx
+        uid = {}
+        text_idx = np.fromiter((uid.setdefault(p, len(uid)) for p in phrases), dtype=np.int32, count=len(phrases))
+        tokens = tokenizer(list(uid), padding="max_length", truncation=True, max_length=self.max_seq_length, return_tensors="np")
+
+        return {
+                # Half precision halves memory and host to device traffic, the
+                # trainer casts back to the model dtype before the loss
+                "targets": np.ascontiguousarray(np.concatenate(targets), dtype=np.float16),
+                "src_lang_ids": np.concatenate(src_lang_ids),
+                "tgt_lang_ids": np.concatenate(tgt_lang_ids),
+                "text_idx": text_idx,
+                "input_ids": tokens['input_ids'].astype(np.int32),
+                "attention_mask": tokens['attention_mask'].astype(np.int8),
+                "token_type_ids": tokens['token_type_ids'].astype(np.int8)
+               }
 
 
     def __getitem__(self, idx):
@@ -62,17 +329,17 @@ class XLingualTrainDataset(Dataset):
         Arguments:
             idx - text index
         '''
-        tokens = self.tokenizer(self.phrases[idx], padding="max_length", truncation=True, max_length=self.max_seq_length)
-        target = torch.tensor(self.targets[idx])
-        label = torch.ones(target.shape[0], 1)
+        # Flat so the scripted collate can take it, the collate nests the
+        # phrase features and adds the labels. Language ids can be decoded
+        # with self.id_to_lang
+        uid = int(self.text_idx[idx])
         return {
-                "phrase": {
-                            'input_ids': torch.tensor(tokens['input_ids']).squeeze(),
-                            'attention_mask': torch.tensor(tokens['attention_mask']).squeeze(),
-                            'token_type_ids': torch.tensor(tokens['token_type_ids']).squeeze()
-                          },
-                "target": target,
-                "label": label
+                'input_ids': self.input_ids_u[uid],
+                'attention_mask': self.attention_u[uid],
+                'token_type_ids': self.token_types_u[uid],
+                "target": self.target_t[idx],
+                "src_id": self.src_lang_t[idx],
+                "target_id": self.tgt_lang_t[idx]
                }
 
     def __len__(self):
@@ -81,7 +348,7 @@ class XLingualTrainDataset(Dataset):
         Returns length of dataset
         '''
 
-        return len(self.phrases)
+        return len(self.target_t)
 
 
 class XLingualLoader(Dataset):
@@ -108,8 +375,9 @@ class XLingualLoader(Dataset):
 
         # Tokenizer for Indian languages
 
-        self.tokenizer = AutoTokenizer.from_pretrained("ai4bharat/indic-bert", max_seq_length=self.max_seq_length)
+        self.tokenizer = get_tokenizer()
         self.language_ids = {'HI': 0, 'BE': 1, 'GU': 2, 'OD': 3, 'PU': 4, 'EN': 5, 'MA': 6}
+        self.cls_id, self.sep_id, self.pad_id = self.tokenizer.convert_tokens_to_ids([self.tokenizer.cls_token, self.tokenizer.sep_token, self.tokenizer.pad_token])
 
 
     def __getitem__(self, idx):
@@ -120,9 +388,8 @@ class XLingualLoader(Dataset):
             idx - text index
         '''
 
-        data = self.convert_dict_2_features(self.dataset_json[idx])
-
-        return self.input_to_tensor(data)
+        # Numpy arrays and ints, tensors are built per batch in the collate
+        return self.convert_dict_2_features(self.dataset_json[idx])
 
 
     def preprocess_tokens(self, input_tokens):
@@ -130,37 +397,32 @@ class XLingualLoader(Dataset):
         Function to add special tags for bert and padd to max length
 
         Arguments:
-            feature_dictionary - Feature dictionary with input_ids, attention mask and type ids
+            input_tokens - list of wordpiece tokens
 
         Return:
             tokens_dictionary - Padded features
         '''
 
-        out = {}
-        tokens = input_tokens
+        return self.preprocess_ids(self.tokenizer.convert_tokens_to_ids(input_tokens))
 
-        special_tokens_count = self.tokenizer.num_special_tokens_to_add()
-        if len(tokens) > self.max_seq_length - special_tokens_count:
-            tokens = tokens[: (self.max_seq_length - special_tokens_count)]
-
-        #  Adding CLS and SEP tokens
-        tokens = [self.tokenizer.cls_token] + tokens + [self.tokenizer.sep_token]
-        token_type_ids  = [0]*len(tokens)
-        attention_mask  = [1]*len(tokens)
-
-        len_before_padd = len(tokens)
+    def preprocess_ids(self, ids):
+        '''
+        Add CLS/SEP ids and pad token ids to max length
 
-        # Adding pad tokens
-        tokens = tokens + [self.tokenizer.pad_token] * (self.max_seq_length - len_before_padd)
-        token_type_ids += [0] * (self.max_seq_length - len_before_padd)
-        attention_mask += [0] * (self.max_seq_length - len_before_padd)
+        Arguments:
+            ids - list of token ids
 
+        Return:
+            tokens_dictionary - Padded features, int32 ids and int8 mask/type ids
+        '''
 
-        out["input_ids"]      = self.tokenizer.convert_tokens_to_ids(tokens)
-        out["token_type_ids"] = token_type_ids
-        out["attention_mask"] = attention_mask
+        input_ids, attention_mask = build_ids(np.asarray(ids, dtype=np.int32), self.cls_id, self.sep_id, self.pad_id, self.max_seq_length)
 
-        return out
+        return {
+                "input_ids": input_ids,
+                "token_type_ids": np.zeros(self.max_seq_length, dtype=np.int8),
+                "attention_mask": attention_mask
+               }
 
     def convert_dict_2_features(self, text_dict):
         '''
@@ -197,31 +459,159 @@ class XLingualLoader(Dataset):
         return len(self.dataset_json)
 
 
-    def input_to_tensor(self, data):
-        '''
-        Convert inputs to tensor
-        '''
-        out = {}
-        for key in data:
-            if isinstance(data[key], dict):
-                if (out.get(key) is None):
-                    out[key] = {}
+@torch.jit.script
+def stack_fields(items: List[Dict[str, torch.Tensor]], pin_memory: bool = False) -> Dict[str, torch.Tensor]:
+    '''
+    Copy every field of the items into one preallocated batch tensor and add
+    the all ones label, scripted to keep the per batch python overhead low
+
+    Arguments:
+        items - list of flat dictionaries of tensors
+        pin_memory - allocate the batch tensors in pinned memory
+
+    Returns:
+        out - dictionary of batched tensors
+    '''
+
+    out: Dict[str, torch.Tensor] = {}
+    for key in items[0].keys():
+        first = items[0][key]
+        stacked = torch.empty([len(items)] + first.size(), dtype=first.dtype, pin_memory=pin_memory)
+        for i in range(len(items)):
+            stacked[i].copy_(items[i][key])
+        out[key] = stacked
+    out["label"] = torch.ones(len(items), dtype=torch.float32, pin_memory=pin_memory)
+
+    return out
+
+
+def pin_collated_batches():
+    '''
+    Whether a collate should allocate its output in pinned memory
+
+    Only done in the main process (num_workers=0): worker processes must not
+    initialize CUDA, their batches are pinned by DataLoader(pin_memory=True).
+    Pinned batches can be moved with .to(device, non_blocking=True) so the
+    copy overlaps with compute.
+    '''
+
+    return get_worker_info() is None and torch.cuda.is_available()
+
+
+def collate_train_batch(batch):
+    '''
+    Collate XLingualTrainDataset items into preallocated batch tensors
+
+    Arguments:
+        batch - list of items from XLingualTrainDataset
+
+    Returns:
+        out - dictionary with batched phrase features, targets, language ids and labels
+    '''
+
+    out = stack_fields(batch, pin_collated_batches())
+    out["phrase"] = {key: out.pop(key) for key in ['input_ids', 'attention_mask', 'token_type_ids']}
 
-                for key_2 in data[key]:
-                    out[key][key_2] = torch.tensor(data[key][key_2], dtype=torch.int)
-            else:
-                out[key] = torch.tensor([data[key]], dtype=torch.int)
+    return out
 
-        return out
 
+def get_train_collate():
+    '''
+    Returns the collate function for XLingualTrainDataset
+    '''
+
+    return collate_train_batch
+
+
+def stack_arrays(arrays, pin_memory=False):
+    '''
+    Copy equally shaped numpy arrays into one preallocated tensor
+
+    Arguments:
+        arrays - sequence of numpy arrays
+        pin_memory - allocate the tensor in pinned memory
+
+    Returns:
+        out - tensor of shape (len(arrays),) + arrays[0].shape
+    '''
+
+    first = np.asarray(arrays[0])
+    out = torch.empty((len(arrays),) + first.shape, dtype=torch.from_numpy(first).dtype, pin_memory=pin_memory)
+    out_np = out.numpy()
+    for i, array in enumerate(arrays):
+        out_np[i] = array
+
+    return out
+
+
+def collate_eval_batch(batch):
+    '''
+    Collate XLingualLoader items into tensors, keeping the feature dtypes
+
+    Arguments:
+        batch - list of feature dictionaries from XLingualLoader
+
+    Returns:
+        out - dictionary of batched tensors
+    '''
+
+    pin_memory = pin_collated_batches()
+    out = {}
+    for key in batch[0]:
+        if isinstance(batch[0][key], dict):
+            out[key] = {}
+            for key_2 in batch[0][key]:
+                out[key][key_2] = stack_arrays([b[key][key_2] for b in batch], pin_memory)
+        else:
+            out[key] = stack_arrays(np.array([b[key] for b in batch], dtype=np.int32), pin_memory)
+
+    return out
+
+
+def get_eval_collate():
+    '''
+    Returns the collate function for XLingualLoader
+    '''
+
+    return collate_eval_batch
+
+
+def worker_init_fn(worker_id):
+    '''
+    DataLoader worker setup: keep each worker to one intra-op thread so the
+    workers do not oversubscribe the cores. OMP_WAIT_POLICY is only read at
+    OpenMP startup, so entry points set it before importing torch
+
+    Arguments:
+        worker_id - id of the DataLoader worker
+    '''
+
+    torch.set_num_threads(1)
 
 
 if __name__ == "__main__":
-    dataset = XLingualTrainDataset(dataset_path="../data/filtered/validation.json", index_path="../models/index")
-    data_loader = DataLoader(dataset, batch_size=128, shuffle=True)
 
-    for batch, data in enumerate(data_loader):
-        #print(batch)
-        print(data["phrase"]["input_ids"].shape)
-        print(data["target"].shape)
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("dataset_path", type=str, nargs="?", default="../data/filtered/validation.json")
+    parser.add_argument("index_dir", type=str, nargs="?", default="../models/index")
+    parser.add_argument("--num_workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    args = parser.parse_args()
+
+    start = time.time()
+    dataset = XLingualTrainDataset(dataset_path=args.dataset_path, index_path=args.index_dir)
+    print("Dataset of {} samples ready in {:.2f}s".format(len(dataset), time.time() - start))
 
+    data_loader = DataLoader(dataset, batch_size=128, shuffle=True, num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                             pin_memory=True, prefetch_factor=4 if args.num_workers > 0 else 2, worker_init_fn=worker_init_fn, collate_fn=get_train_collate())
+
+    shapes = None
+    start = time.time()
+    for batch, data in enumerate(data_loader):
+        if batch == 0:
+            shapes = (data["phrase"]["input_ids"].shape, data["target"].shape)
+    elapsed = time.time() - start
+
+    if shapes is not None:
+        print(shapes[0])
+        print(shapes[1])
+    print("{} batches in {:.2f}s".format(len(data_loader), elapsed))
@@ -9,13 +9,12 @@ import faiss
 import os
 from trainer import XlingualDictionary
 from collections import defaultdict
-from transformers import AutoTokenizer
 from helper_functions import read_json_file
 
 def get_accuracy(test_data, model, index_dir, k=10, batch_size=32):
 
     model.eval()
-    tokenizer = AutoTokenizer.from_pretrained("ai4bharat/indic-bert")
+    tokenizer = data_loader.get_tokenizer()
 
     #lang_map = {"EN": "en"}
 
@@ -59,7 +58,7 @@ def xlingual_reverse_dictionary(model, index_dir, k):
 
     model.eval()
 
-    tokenizer = AutoTokenizer.from_pretrained("ai4bharat/indic-bert")
+    tokenizer = data_loader.get_tokenizer()
 
     #lang_map = {"EN": "en"}
     lang_map = {'HI': 'hi', 'BE': 'bn', 'GU': 'gu', 'OD': 'or', 'PU': 'pa', 'EN': 'en', 'MA': 'mr'}
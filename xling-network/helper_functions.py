@@ -1,5 +1,28 @@
 import json
 import argparse
+import pathlib
+
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
+
+def parse_json_bytes(json_bytes):
+
+    '''
+    Function to parse json already read from disk
+
+    Arguments:
+        json_bytes - raw file contents
+
+    Returns:
+        json object
+    '''
+
+    return fast_json.loads(json_bytes)
 
 def read_json_file(file_path):
 
@@ -13,9 +36,7 @@ def read_json_file(file_path):
         json object
     '''
 
-    with open(file_path) as fp:
-
-        input_dictionary = json.load(fp)
+    input_dictionary = parse_json_bytes(pathlib.Path(file_path).read_bytes())
 
 
     return input_dictionary
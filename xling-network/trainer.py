@@ -1,3 +1,9 @@
+import os
+
+if __name__ == "__main__":
+    # Read once when OpenMP starts, i.e. on the torch import below
+    os.environ.setdefault("OMP_WAIT_POLICY", "PASSIVE")
+
 import argparse
 
 import torch
@@ -9,6 +15,19 @@ import faiss
 from transformers import AdamW, AutoModel
 import torch.nn as nn
 
+def encoder_inputs(x):
+    '''
+    Cast the narrow token id tensors from the data loader to the int64 the
+    embedding layers expect, the attention mask is used as is
+    '''
+
+    out = dict(x)
+    for key in ['input_ids', 'token_type_ids']:
+        if key in out:
+            out[key] = out[key].long()
+
+    return out
+
 class XlingualDictionary(pl.LightningModule):
     '''
     Cross lingual dictionary model
@@ -24,7 +43,7 @@ class XlingualDictionary(pl.LightningModule):
         self.activation = nn.Tanh()
 
     def forward(self, x, index_path, k=1):
-        outputs = self.encoder(**x)
+        outputs = self.encoder(**encoder_inputs(x))
         #sequence_outputs = outputs[2]#.last_hidden_state
         #sequence_outputs = torch.cat(sequence_outputs, dim = 0)
         #sequence_outputs = torch.mean(sequence_outputs,  0).unsqueeze(0)
@@ -42,14 +61,14 @@ class XlingualDictionary(pl.LightningModule):
     def training_step(self, batch, batch_idx):
 
         x, y, label =  batch["phrase"], batch["target"], batch["label"]
-        outputs = self.encoder(**x)
+        outputs = self.encoder(**encoder_inputs(x))
         #sequence_outputs = outputs[2]#.last_hidden_state
         #sequence_outputs = torch.cat(sequence_outputs, dim = 0)
         #sequence_outputs = torch.mean(sequence_outputs,  0).unsqueeze(0)
         #sequence_embedding = torch.mean(sequence_outputs, 1)
         sequence_embedding = outputs[1]
         y_hat = self.activation(self.map(sequence_embedding))
-        loss = F.cosine_embedding_loss(y_hat, y, label)
+        loss = F.cosine_embedding_loss(y_hat, y.to(y_hat.dtype), label)
 
         self.log('train_loss', loss)
 
@@ -57,14 +76,14 @@ class XlingualDictionary(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         x, y, label =  batch["phrase"], batch["target"], batch["label"]
-        outputs = self.encoder(**x)
+        outputs = self.encoder(**encoder_inputs(x))
         #sequence_outputs = outputs[2]#.last_hidden_state
         #sequence_outputs = torch.cat(sequence_outputs, dim = 0)
         #sequence_outputs = torch.mean(sequence_outputs,  0).unsqueeze(0)
         #sequence_embedding = torch.mean(sequence_outputs, 1)
         sequence_embedding = outputs[1]
         y_hat = self.activation(self.map(sequence_embedding))
-        loss = F.cosine_embedding_loss(y_hat, y, label)
+        loss = F.cosine_embedding_loss(y_hat, y.to(y_hat.dtype), label)
         self.log('val_loss', loss)
         return loss
 
@@ -87,10 +106,12 @@ if __name__=="__main__":
 
     args = parser.parse_args()
     train_dataset = data_loader.XLingualTrainDataset(args.train_data, args.index_dir)
-    train_dataloader = DataLoader(train_dataset, batch_size=32, shuffle=True, num_workers=10, drop_last = True)
+    train_dataloader = DataLoader(train_dataset, batch_size=32, shuffle=True, num_workers=10, persistent_workers=True, pin_memory=True, prefetch_factor=4, drop_last = True,
+                                  worker_init_fn=data_loader.worker_init_fn, collate_fn=data_loader.get_train_collate())
 
     val_dataset = data_loader.XLingualTrainDataset(args.val_data, args.index_dir)
-    val_dataloader = DataLoader(val_dataset, batch_size=32, num_workers=10, drop_last = True)
+    val_dataloader = DataLoader(val_dataset, batch_size=32, num_workers=10, persistent_workers=True, pin_memory=True, prefetch_factor=4, drop_last = True,
+                                worker_init_fn=data_loader.worker_init_fn, collate_fn=data_loader.get_train_collate())
 
     trainer = pl.Trainer(gpus=-1, max_epochs=args.n_epochs, distributed_backend='dp', prepare_data_per_node=False, num_nodes = 1, num_sanity_val_steps=0)
     encoder = AutoModel.from_pretrained("ai4bharat/indic-bert", output_hidden_states = True, cache_dir=args.encoder_cache_dir, return_dict=True)